@@ -2,13 +2,311 @@
 import os
 import sys
 import cmd
-import glob
+import mmap
+import fcntl
+import queue
 import subprocess
 import threading
+import errno
+import re
 import readline
+import select
 import signal
+import termios
+import tty
+import time
 from functools import wraps
 
+# Small writes (dd defaults to 512 bytes) are far too slow for flashing images
+DEFAULT_WRITE_BS = 8 << 20
+# Buffers in flight between the reader and writer threads
+WRITE_BUFFERS = 4
+# Bytes moved per splice() call, the pipe is grown to match
+SPLICE_CHUNK = 1 << 20
+
+# HID modifier bit used for shifted characters
+KEY_MOD_SHIFT = 0x20
+
+# US layout usage IDs for the characters reachable without letters/digits,
+# as (unshifted, shifted, usage id)
+_PUNCTUATION_KEYS = (
+    ("\n", None, 40),  # Enter
+    ("\r", None, 40),  # Enter, when the tty doesn't translate CR
+    ("\x1b", None, 41),  # Escape
+    ("\x7f", None, 42),  # Backspace
+    ("\t", None, 43),  # Tab
+    (" ", None, 44),
+    ("-", "_", 45),
+    ("=", "+", 46),
+    ("[", "{", 47),
+    ("]", "}", 48),
+    ("\\", "|", 49),
+    (";", ":", 51),
+    ("'", '"', 52),
+    ("`", "~", 53),
+    (",", "<", 54),
+    (".", ">", 55),
+    ("/", "?", 56),
+)
+
+def _build_key_table():
+    """Lay out the 8 byte HID key press report of every ASCII code point,
+    so the report for a character is _KEY_TABLE[8 * ord(c):8 * ord(c) + 8].
+    Characters without a key are left as all-zero reports."""
+    table = bytearray(128 * 8)
+    def put(char, modifier, usage):
+        offset = 8 * ord(char)
+        table[offset] = modifier
+        table[offset + 2] = usage
+
+    for i, letter in enumerate("abcdefghijklmnopqrstuvwxyz"):
+        put(letter, 0, 4 + i)
+        put(letter.upper(), KEY_MOD_SHIFT, 4 + i)
+    for i, (digit, symbol) in enumerate(zip("1234567890", "!@#$%^&*()")):
+        put(digit, 0, 30 + i)
+        put(symbol, KEY_MOD_SHIFT, 30 + i)
+    for plain, shifted, usage in _PUNCTUATION_KEYS:
+        put(plain, 0, usage)
+        if shifted:
+            put(shifted, KEY_MOD_SHIFT, usage)
+    return bytes(table)
+
+_KEY_TABLE = _build_key_table()
+# Terminal escape sequences (arrows, function keys, Alt+key). A lone ESC at
+# the end of a read is the Escape key itself and is left alone.
+_ESCAPE_SEQUENCE = re.compile(rb"\x1b(?:[\[O][\x30-\x3f]*[\x20-\x2f]*[\x40-\x7e]|.)", re.S)
+_RELEASE = bytes(8)
+
+# Boot protocol keyboard: modifier byte, reserved byte and six key codes
+_HID_KEYBOARD_REPORT_DESC = bytes.fromhex(
+    "0501"  # Usage Page (Generic Desktop)
+    "0906"  # Usage (Keyboard)
+    "a101"  # Collection (Application)
+    "0507"  # Usage Page (Key Codes)
+    "19e0"  # Usage Minimum (224)
+    "29e7"  # Usage Maximum (231)
+    "1500"  # Logical Minimum (0)
+    "2501"  # Logical Maximum (1)
+    "7501"  # Report Size (1)
+    "9508"  # Report Count (8)
+    "8102"  # Input (Data, Variable, Absolute)
+    "9501"  # Report Count (1)
+    "7508"  # Report Size (8)
+    "8103"  # Input (Constant)
+    "9506"  # Report Count (6)
+    "7508"  # Report Size (8)
+    "1500"  # Logical Minimum (0)
+    "2565"  # Logical Maximum (101)
+    "0507"  # Usage Page (Key Codes)
+    "1900"  # Usage Minimum (0)
+    "2965"  # Usage Maximum (101)
+    "8100"  # Input (Data, Array)
+    "c0"    # End Collection
+)
+
+# Bytes of keyboard input taken from stdin per read
+KEY_READ_SIZE = 256
+# Pending HID reports; a press and a release per character plus the
+# final release, so a whole read batch always fits
+KEY_QUEUE_SIZE = 2 * KEY_READ_SIZE + 1
+
+# Seconds a directory listing is reused for tab completion
+LISTING_TTL = 2
+
+# Serial number the gadget reports to the host
+GADGET_SERIAL = "pinephone123456"
+
+# configfs layout of the gadget, relative to its directory. configfs
+# creates strings/, functions/, configs/ and c.1/strings/ by itself.
+_GADGET_DIRS = (
+    "strings/0x409",
+    "functions/hid.keyboard",
+    "functions/mass_storage.0",
+    "configs/c.1",
+    "configs/c.1/strings/0x409",
+)
+# Attributes grouped by the directory they live in
+_GADGET_ATTRS = (
+    (".", (
+        ("idVendor", "0x1f3a"),  # Pine64
+        ("idProduct", "0x1001"),  # Generic USB device
+        ("bcdDevice", "0x0100"),
+        ("bcdUSB", "0x0200"),
+    )),
+    ("strings/0x409", (
+        ("serialnumber", GADGET_SERIAL),
+        ("manufacturer", "Pine64"),
+        ("product", "Pinephone Lab Tool"),
+    )),
+    ("functions/hid.keyboard", (
+        ("protocol", "1"),
+        ("subclass", "1"),
+        ("report_length", "8"),
+        ("report_desc", _HID_KEYBOARD_REPORT_DESC),
+    )),
+    ("configs/c.1", (
+        ("MaxPower", "500"),
+    )),
+    ("configs/c.1/strings/0x409", (
+        ("configuration", "Config 1: HID + Mass Storage"),
+    )),
+)
+
+def _wattr(path, value, dir_fd=None):
+    """Write a sysfs/configfs attribute with a single unbuffered write"""
+    fd = os.open(path, os.O_WRONLY, dir_fd=dir_fd)
+    try:
+        os.write(fd, value if isinstance(value, bytes) else value.encode())
+    finally:
+        os.close(fd)
+
+def _write_dir(path, items, dir_fd=None):
+    """Write (name, value) attributes that share one directory, resolving
+    the directory only once"""
+    parent = os.open(path, os.O_PATH | os.O_DIRECTORY, dir_fd=dir_fd)
+    try:
+        for name, value in items:
+            _wattr(name, value, parent)
+    finally:
+        os.close(parent)
+
+def _module_loaded(name):
+    """Check whether a loadable kernel module is currently loaded"""
+    return os.path.isdir(f"/sys/module/{name}")
+
+def _queue_limit(device, attr):
+    """Read a queue/ limit of a block device, or None if it isn't exposed"""
+    name = os.path.basename(os.path.realpath(device))
+    sys_path = os.path.realpath(f"/sys/class/block/{name}")
+    # Partitions share the queue limits of their parent disk
+    for path in (sys_path, os.path.dirname(sys_path)):
+        try:
+            with open(f"{path}/queue/{attr}") as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            continue
+    return None
+
+def _optimal_block_size(device):
+    """Return the preferred write size in bytes for a block device"""
+    optimal = _queue_limit(device, "optimal_io_size")
+    if optimal and optimal > 4 << 20:
+        return optimal
+    return DEFAULT_WRITE_BS
+
+def _logical_block_size(device):
+    """Return the size O_DIRECT writes to a block device must be a multiple of"""
+    return _queue_limit(device, "logical_block_size") or 512
+
+def _print_progress(done, total):
+    """Print a one-line progress report for a running copy"""
+    print(f"\r{done >> 20} of {total >> 20} MiB written", end="", flush=True)
+
+def _pipelined_copy(src_fd, dst_fd, bs, block_size, total):
+    """Copy src_fd to dst_fd, overlapping reads and writes on two threads.
+    dst_fd may be opened O_DIRECT with writes aligned to block_size."""
+    free = queue.Queue()
+    filled = queue.Queue(maxsize=WRITE_BUFFERS)
+    for _ in range(WRITE_BUFFERS):
+        # Anonymous maps are page aligned, as O_DIRECT requires
+        free.put(mmap.mmap(-1, bs))
+    errors = []
+    done = 0
+
+    def reader():
+        try:
+            while True:
+                buf = free.get()
+                n = 0 if errors else os.readv(src_fd, [buf])
+                filled.put((buf, n))
+                if not n:
+                    return
+        except OSError as e:
+            errors.append(e)
+            filled.put((None, 0))
+
+    def writer():
+        nonlocal done
+        while True:
+            buf, n = filled.get()
+            if not n:
+                return
+            if not errors:
+                try:
+                    if n % block_size:
+                        # O_DIRECT can't write the unaligned tail of the image
+                        flags = fcntl.fcntl(dst_fd, fcntl.F_GETFL)
+                        fcntl.fcntl(dst_fd, fcntl.F_SETFL, flags & ~os.O_DIRECT)
+                    view = memoryview(buf)[:n]
+                    while view:
+                        view = view[os.write(dst_fd, view):]
+                    done += n
+                except OSError as e:
+                    errors.append(e)
+            free.put(buf)
+
+    threads = [threading.Thread(target=reader, daemon=True),
+               threading.Thread(target=writer, daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        while threads[1].is_alive():
+            threads[1].join(1)
+            _print_progress(done, total)
+    except BaseException as e:
+        # Let the reader wind down before handing the error on
+        errors.append(e)
+        raise
+    if errors:
+        raise errors[0]
+    os.fdatasync(dst_fd)
+
+def _splice_copy(src_fd, dst_fd, total):
+    """Copy src_fd to dst_fd through a pipe with splice(), all in the kernel.
+    Returns False if either end refuses splice during the first chunk. The
+    ISO is rewound, but part of that chunk may already be on the device, so
+    the caller must restart from the device's start."""
+    pipe_r, pipe_w = os.pipe()
+    try:
+        try:
+            fcntl.fcntl(pipe_w, fcntl.F_SETPIPE_SZ, SPLICE_CHUNK)
+        except OSError:
+            pass  # Capped by /proc/sys/fs/pipe-max-size, keep the default
+
+        stop = threading.Event()
+        def report():
+            while not stop.wait(1):
+                _print_progress(os.lseek(src_fd, 0, os.SEEK_CUR), total)
+        progress = threading.Thread(target=report, daemon=True)
+        progress.start()
+        started = False
+        try:
+            while True:
+                try:
+                    n = os.splice(src_fd, pipe_w, SPLICE_CHUNK, flags=os.SPLICE_F_MOVE)
+                    if not n:
+                        break
+                    while n:
+                        n -= os.splice(pipe_r, dst_fd, n, flags=os.SPLICE_F_MOVE)
+                except OSError as e:
+                    if started or e.errno not in (errno.EINVAL, errno.ENOSYS):
+                        raise
+                    # Still in the first chunk, rewind so another copier can start over
+                    os.lseek(src_fd, 0, os.SEEK_SET)
+                    return False
+                started = True
+        finally:
+            stop.set()
+            progress.join()
+        os.fdatasync(dst_fd)
+        _print_progress(total, total)
+        # The device was written through the page cache, don't leave it there
+        os.posix_fadvise(dst_fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        return True
+    finally:
+        os.close(pipe_r)
+        os.close(pipe_w)
+
 class LabTool(cmd.Cmd):
     intro = '''Pinephone Lab Tool - USB Gadget and ISO Tool
 Type help or ? to list commands.
@@ -28,6 +326,11 @@ Examples:
         self.usb_gadget_configured = False
         self.keyboard_active = False
         self.keyboard_thread = None
+        self._hid_thread = None
+        self._hidfd = None
+        self._key_q = queue.Queue(maxsize=KEY_QUEUE_SIZE)
+        self._last_key = None
+        self._listing_cache = {}
         self.emulating = False
         
         # Enable tab completion for file paths
@@ -40,25 +343,38 @@ Examples:
         """Safely clean up existing USB gadget configuration"""
         try:
             gadget_path = "/sys/kernel/config/usb_gadget/g1"
-            if os.path.exists(gadget_path):
+            try:
+                configs = os.scandir(f"{gadget_path}/configs")
+            except FileNotFoundError:
+                configs = None
+            # libcomposite, loaded or built in, provides the configfs usb_gadget dir
+            if (configs is None and os.path.isdir("/sys/kernel/config/usb_gadget")
+                    and not _module_loaded("g_multi")):
+                # Nothing to tear down and nothing to load
+                return
+            if configs is not None:
                 # First disable the UDC
                 try:
-                    with open(f"{gadget_path}/UDC", "w") as f:
-                        f.write("")
+                    # An empty write never reaches the kernel, send a newline
+                    _wattr(f"{gadget_path}/UDC", "\n")
                 except:
                     pass
 
                 # Remove symlinks in reverse order
-                for config in glob.glob(f"{gadget_path}/configs/*/"):
-                    for f in glob.glob(f"{config}*"):
-                        if os.path.islink(f):
-                            os.unlink(f)
+                with configs:
+                    for config in configs:
+                        if not config.is_dir(follow_symlinks=False):
+                            continue
+                        with os.scandir(config.path) as entries:
+                            for f in entries:
+                                if f.is_symlink():
+                                    os.unlink(f.path)
 
                 # Remove the gadget directory structure
                 subprocess.run(["rmdir", "-p", "--ignore-fail-on-non-empty", gadget_path])
                 
-            os.system("rmmod g_multi 2>/dev/null || true")
-            os.system("modprobe libcomposite")
+            subprocess.run(["rmmod", "g_multi"], stderr=subprocess.DEVNULL, check=False)
+            subprocess.run(["modprobe", "libcomposite"], check=False)
         except Exception as e:
             print(f"Note: Partial gadget config may exist: {e}")
 
@@ -86,21 +402,34 @@ Examples:
         print()  # Add newline
         return self.do_exit(arg)
         
+    def _list_dir(self, directory):
+        """Return the entry names of a directory, cached between Tab presses"""
+        mtime = os.stat(directory).st_mtime_ns
+        cached = self._listing_cache.get(directory)
+        now = time.monotonic()
+        if cached and cached[0] == mtime and now - cached[1] < LISTING_TTL:
+            return cached[2]
+        with os.scandir(directory) as it:
+            names = [entry.name for entry in it]
+        self._listing_cache[directory] = (mtime, now, names)
+        return names
+    
     def complete_iso(self, text, line, begidx, endidx):
         """Tab completion for ISO files"""
-        if not text:
-            completions = glob.glob('*.iso')
-        else:
-            completions = glob.glob(f'{text}*.iso')
-        return completions
+        directory, prefix = os.path.split(text)
+        try:
+            names = self._list_dir(directory or '.')
+        except OSError:
+            return []
+        return [os.path.join(directory, name) for name in names
+                if name.startswith(prefix) and name.endswith('.iso')
+                and (prefix.startswith('.') or not name.startswith('.'))]
     
     def complete_device(self, text, line, begidx, endidx):
         """Tab completion for device paths"""
-        if not text:
-            completions = glob.glob('/dev/sd*')
-        else:
-            completions = glob.glob(f'/dev/sd{text}*')
-        return completions
+        prefix = f'sd{text}'
+        return [f'/dev/{name}' for name in self._list_dir('/dev')
+                if name.startswith(prefix)]
     
     def do_iso(self, arg):
         """Select an ISO file to work with
@@ -112,9 +441,14 @@ Usage: iso <path/to/file.iso>"""
                 print("No ISO file selected")
             return
             
-        if not os.path.exists(arg):
+        try:
+            open(arg, 'rb').close()
+        except FileNotFoundError:
             print(f"File not found: {arg}")
             return
+        except OSError as e:
+            print(f"Cannot read {arg}: {e.strerror}")
+            return
             
         self.selected_iso = os.path.abspath(arg)
         print(f"Selected ISO: {self.selected_iso}")
@@ -132,113 +466,85 @@ Example: write /dev/sda"""
             print("No device specified")
             return
             
-        if not os.path.exists(arg):
+        try:
+            dev_fd = os.open(arg, os.O_WRONLY)
+        except FileNotFoundError:
             print(f"Device not found: {arg}")
             return
+        except OSError as e:
+            print(f"Cannot open {arg}: {e.strerror}")
+            return
             
         print(f"Writing {self.selected_iso} to {arg}")
         print("Press Ctrl+C to cancel")
         
         try:
-            cmd = ['dd', f'if={self.selected_iso}', f'of={arg}', 'bs=4M', 'status=progress']
-            subprocess.run(cmd)
+            iso_fd = os.open(self.selected_iso, os.O_RDONLY)
+        except OSError as e:
+            os.close(dev_fd)
+            print(f"Cannot open {self.selected_iso}: {e.strerror}")
+            return
+        try:
+            # The ISO is streamed once, keep it from flooding the page cache
+            os.posix_fadvise(iso_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(iso_fd, 0, 0, os.POSIX_FADV_NOREUSE)
+
+            total = os.fstat(iso_fd).st_size
+            # os.splice needs Python 3.10, older interpreters go straight to
+            # the fallback
+            if not (hasattr(os, "splice") and _splice_copy(iso_fd, dev_fd, total)):
+                # Copy through user space buffers that bypass the cache instead,
+                # on a fresh fd so the device is rewritten from its start
+                direct_fd = os.open(arg, os.O_WRONLY | os.O_DIRECT)
+                os.close(dev_fd)
+                dev_fd = direct_fd
+                _pipelined_copy(iso_fd, dev_fd, _optimal_block_size(arg),
+                                _logical_block_size(arg), total)
             print("\nWrite completed successfully")
-        except subprocess.CalledProcessError as e:
+        except OSError as e:
             print(f"\nError writing ISO: {e}")
         except KeyboardInterrupt:
             print("\nWrite cancelled")
+        finally:
+            # Drop whatever part of the image still sits in the page cache
+            os.posix_fadvise(iso_fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            os.close(iso_fd)
+            os.close(dev_fd)
     
     def configure_usb_gadget(self):
         """Configure USB gadget with HID and mass storage functions"""
         try:
-            self.cleanup_gadget()
-            
             gadget_path = "/sys/kernel/config/usb_gadget/g1"
             
+            self.cleanup_gadget()
+            
             # Create gadget directory
             os.makedirs(gadget_path, exist_ok=True)
-            os.chdir(gadget_path)
-            
-            # Set USB device parameters
-            with open("idVendor", "w") as f:
-                f.write("0x1f3a")  # Pine64
-            with open("idProduct", "w") as f:
-                f.write("0x1001")  # Generic USB device
-            with open("bcdDevice", "w") as f:
-                f.write("0x0100")
-            with open("bcdUSB", "w") as f:
-                f.write("0x0200")
-            
-            # Create strings
-            os.makedirs("strings/0x409", exist_ok=True)
-            with open("strings/0x409/serialnumber", "w") as f:
-                f.write("pinephone123456")
-            with open("strings/0x409/manufacturer", "w") as f:
-                f.write("Pine64")
-            with open("strings/0x409/product", "w") as f:
-                f.write("Pinephone Lab Tool")
-            
-            # Setup HID keyboard
-            os.makedirs("functions/hid.keyboard", exist_ok=True)
-            with open("functions/hid.keyboard/protocol", "w") as f:
-                f.write("1")
-            with open("functions/hid.keyboard/subclass", "w") as f:
-                f.write("1")
-            with open("functions/hid.keyboard/report_length", "w") as f:
-                f.write("8")
-            
-            # Write HID report descriptor
-            report_desc = [
-                0x05, 0x01,  # Usage Page (Generic Desktop)
-                0x09, 0x06,  # Usage (Keyboard)
-                0xA1, 0x01,  # Collection (Application)
-                0x05, 0x07,  # Usage Page (Key Codes)
-                0x19, 0xE0,  # Usage Minimum (224)
-                0x29, 0xE7,  # Usage Maximum (231)
-                0x15, 0x00,  # Logical Minimum (0)
-                0x25, 0x01,  # Logical Maximum (1)
-                0x75, 0x01,  # Report Size (1)
-                0x95, 0x08,  # Report Count (8)
-                0x81, 0x02,  # Input (Data, Variable, Absolute)
-                0x95, 0x01,  # Report Count (1)
-                0x75, 0x08,  # Report Size (8)
-                0x81, 0x03,  # Input (Constant)
-                0x95, 0x06,  # Report Count (6)
-                0x75, 0x08,  # Report Size (8)
-                0x15, 0x00,  # Logical Minimum (0)
-                0x25, 0x65,  # Logical Maximum (101)
-                0x05, 0x07,  # Usage Page (Key Codes)
-                0x19, 0x00,  # Usage Minimum (0)
-                0x29, 0x65,  # Usage Maximum (101)
-                0x81, 0x00,  # Input (Data, Array)
-                0xC0        # End Collection
-            ]
-            with open("functions/hid.keyboard/report_desc", "wb") as f:
-                f.write(bytes(report_desc))
-            
-            # Setup mass storage
-            os.makedirs("functions/mass_storage.0", exist_ok=True)
-            
-            # Create config
-            os.makedirs("configs/c.1/strings/0x409", exist_ok=True)
-            with open("configs/c.1/strings/0x409/configuration", "w") as f:
-                f.write("Config 1: HID + Mass Storage")
-            with open("configs/c.1/MaxPower", "w") as f:
-                f.write("500")
-            
-            # Create symlinks
-            os.symlink(f"{gadget_path}/functions/hid.keyboard", 
-                      f"{gadget_path}/configs/c.1/hid.keyboard")
-            os.symlink(f"{gadget_path}/functions/mass_storage.0",
-                      f"{gadget_path}/configs/c.1/mass_storage.0")
-            
-            # Enable gadget
-            udc = os.listdir("/sys/class/udc")[0]
-            with open("UDC", "w") as f:
-                f.write(udc)
+            gadget_fd = os.open(gadget_path, os.O_PATH | os.O_DIRECTORY)
+            try:
+                # Create the function/config directories, then fill in attributes
+                for directory in _GADGET_DIRS:
+                    try:
+                        os.mkdir(directory, dir_fd=gadget_fd)
+                    except FileExistsError:
+                        pass
+                for directory, items in _GADGET_ATTRS:
+                    _write_dir(directory, items, gadget_fd)
+                
+                # Create symlinks
+                os.symlink(f"{gadget_path}/functions/hid.keyboard",
+                           "configs/c.1/hid.keyboard", dir_fd=gadget_fd)
+                os.symlink(f"{gadget_path}/functions/mass_storage.0",
+                           "configs/c.1/mass_storage.0", dir_fd=gadget_fd)
+                
+                # Enable gadget
+                udc = os.listdir("/sys/class/udc")[0]
+                _wattr("UDC", udc, gadget_fd)
+            finally:
+                os.close(gadget_fd)
             
             # Set permissions
-            os.system("chmod 666 /dev/hidg0")
+            os.chmod("/dev/hidg0", 0o666)
             
             self.usb_gadget_configured = True
             return True
@@ -254,8 +560,7 @@ Usage: emulate [start|stop]"""
         if arg == 'stop':
             if self.emulating:
                 try:
-                    with open("/sys/kernel/config/usb_gadget/g1/functions/mass_storage.0/lun.0/file", "w") as f:
-                        f.write("")
+                    _wattr("/sys/kernel/config/usb_gadget/g1/functions/mass_storage.0/lun.0/file", "\n")
                     self.emulating = False
                     print("ISO emulation stopped")
                 except Exception as e:
@@ -272,8 +577,7 @@ Usage: emulate [start|stop]"""
                 return
         
         try:
-            with open("/sys/kernel/config/usb_gadget/g1/functions/mass_storage.0/lun.0/file", "w") as f:
-                f.write(self.selected_iso)
+            _wattr("/sys/kernel/config/usb_gadget/g1/functions/mass_storage.0/lun.0/file", self.selected_iso)
             self.emulating = True
             print(f"Emulating {os.path.basename(self.selected_iso)} over USB")
         except Exception as e:
@@ -281,50 +585,57 @@ Usage: emulate [start|stop]"""
     
     def keyboard_thread_func(self):
         """Thread for handling keyboard input"""
-        os.system("stty -echo -icanon")
+        fd = sys.stdin.fileno()
+        old_attrs = termios.tcgetattr(fd)
+        tty.setcbreak(fd)
         try:
             while self.keyboard_active:
-                char = sys.stdin.read(1)
-                if char:
-                    self.send_key(char)
+                if not select.select([fd], [], [], 0.1)[0]:
+                    continue
+                # Take everything that is waiting, pastes arrive in one go
+                data = _ESCAPE_SEQUENCE.sub(b"", os.read(fd, KEY_READ_SIZE))
+                for byte in data:
+                    self.send_key(chr(byte))
+                self.release_keys()
         except Exception as e:
             print(f"Keyboard error: {e}")
         finally:
-            os.system("stty echo icanon")
+            termios.tcsetattr(fd, termios.TCSADRAIN, old_attrs)
     
     def send_key(self, key_chr):
         """Send a single key press event"""
-        NULL_CHAR = chr(0)
-        
-        try:
-            if key_chr.isalpha():
-                if key_chr.isupper():
-                    # Shift + key for uppercase
-                    self.write_hid_report(chr(32) + NULL_CHAR + chr(ord(key_chr.lower()) - 93) + NULL_CHAR * 5)
-                else:
-                    # Regular key for lowercase
-                    self.write_hid_report(NULL_CHAR * 2 + chr(ord(key_chr) - 93) + NULL_CHAR * 5)
-            elif key_chr in "1234567890":
-                # Number keys
-                self.write_hid_report(NULL_CHAR * 2 + chr(ord(key_chr) - 19) + NULL_CHAR * 5)
-            elif key_chr == "\n":
-                # Enter key
-                self.write_hid_report(NULL_CHAR * 2 + chr(40) + NULL_CHAR * 5)
-            elif key_chr == " ":
-                # Space key
-                self.write_hid_report(NULL_CHAR * 2 + chr(44) + NULL_CHAR * 5)
-            
-            # Release all keys
-            self.write_hid_report(NULL_CHAR * 8)
-            
-        except Exception as e:
-            print(f"Error sending key: {e}")
+        offset = 8 * ord(key_chr)
+        report = _KEY_TABLE[offset:offset + 8]
+        if report and report[2]:
+            # A new key press replaces the held one, only repeating the same
+            # key needs a release in between for the host to see two presses
+            if self._last_key and self._last_key[2] == report[2]:
+                self.queue_hid_report(_RELEASE)
+            self.queue_hid_report(report)
+            self._last_key = report
+
+    def release_keys(self):
+        """Release the held key, if any"""
+        if self._last_key:
+            self.queue_hid_report(_RELEASE)
+            self._last_key = None
+    
+    def queue_hid_report(self, report):
+        """Hand a HID report to the sender thread, waiting if it is behind"""
+        self._key_q.put(report)
+    
+    def hid_sender_thread_func(self):
+        """Thread writing queued HID reports to the keyboard device"""
+        while True:
+            report = self._key_q.get()
+            if report is None:
+                return
+            self.write_hid_report(report)
     
     def write_hid_report(self, report):
         """Write HID report to keyboard device"""
         try:
-            with open('/dev/hidg0', 'rb+') as fd:
-                fd.write(report.encode())
+            self._hidfd.write(report)
         except Exception as e:
             print(f"Error writing HID report: {e}")
     
@@ -337,6 +648,11 @@ Usage: keyboard [start|stop]"""
                 self.keyboard_active = False
                 if self.keyboard_thread:
                     self.keyboard_thread.join()
+                # Let the sender flush what is queued, then stop it
+                self.queue_hid_report(None)
+                self._hid_thread.join()
+                self._hidfd.close()
+                self._hidfd = None
                 print("Virtual keyboard stopped")
             return
             
@@ -346,8 +662,18 @@ Usage: keyboard [start|stop]"""
                 return
         
         if not self.keyboard_active:
+            try:
+                # Held open while the keyboard runs rather than per report
+                # No O_CREAT, a missing node must not turn into a regular file
+                self._hidfd = os.fdopen(os.open('/dev/hidg0', os.O_WRONLY), 'wb', buffering=0)
+            except OSError as e:
+                print(f"Error opening HID device: {e}")
+                return
             self.keyboard_active = True
             print("Virtual keyboard started. Type to send keys, Ctrl+C to stop.")
+            self._hid_thread = threading.Thread(target=self.hid_sender_thread_func)
+            self._hid_thread.daemon = True
+            self._hid_thread.start()
             self.keyboard_thread = threading.Thread(target=self.keyboard_thread_func)
             self.keyboard_thread.daemon = True
             self.keyboard_thread.start()